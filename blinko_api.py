@@ -7,64 +7,94 @@ Features:
 - Token validation via GET request
 - Handles SSL verification and timeouts
 - Supports both note types (0=note, 1=blinko)
+- Non-blocking requests via httpx.AsyncClient
 """
 
-import requests
+import httpx
+import functools
+import hashlib
 import logging
-from typing import Dict, Any
-from urllib.parse import urljoin
+import orjson
+import time
+from typing import Dict, Any, Optional, Tuple, Union
 
 logger = logging.getLogger(__name__)
 
+# How long a successful token validation is reused before re-checking (seconds)
+TOKEN_CACHE_TTL = 300
+
+# Tokens are accepted as str or, straight from storage, as bytes
+Token = Union[str, bytes]
+
+# Client configuration shared by every BlinkoAPI instance, built once at import.
+# Keep a sized keep-alive pool so bursts of notes against the same Blinko host
+# reuse connections instead of paying new handshakes.
+CLIENT_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+CLIENT_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+# Content-Type is only sent on requests that carry a JSON body
+CLIENT_HEADERS = {'User-Agent': 'BlinkoTelegramBot/1.0'}
+
+@functools.lru_cache(maxsize=128)
+def _auth_headers(token: Token) -> Dict[str, bytes]:
+    """Build the Authorization headers for a token, shared between calls.
+
+    The returned dict is cached and must not be mutated by callers.
+    """
+    if isinstance(token, str):
+        token = token.encode()
+    return {'Authorization': b'Bearer ' + token}
+
+@functools.lru_cache(maxsize=128)
+def _json_headers(token: Token) -> Dict[str, Any]:
+    """Build the headers for a pre-serialized JSON request body."""
+    return {**_auth_headers(token), 'Content-Type': 'application/json'}
+
 class BlinkoAPI:
     """Simple Blinko API client for note creation."""
     
     def __init__(self, base_url: str):
         self.base_url = base_url
-        self.session = requests.Session()
-        self.session.headers.update({
-            'Content-Type': 'application/json',
-            'User-Agent': 'BlinkoTelegramBot/1.0'
-        })
+        # Resolve endpoint URLs once instead of on every request
+        self._base = self.base_url.rstrip('/')
+        self._upsert_url = f"{self._base}/note/upsert"
+        self._note_url = f"{self._base}/note"
         # Disable SSL verification for self-signed certificates
         # In production, you should use proper SSL certificates
-        self.session.verify = False
-        # Suppress SSL warnings
-        import urllib3
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        # Retries only cover failed connection attempts, so a note is never
+        # posted twice.
+        transport = httpx.AsyncHTTPTransport(verify=False, limits=CLIENT_LIMITS, retries=3)
+        self._client = httpx.AsyncClient(
+            headers=CLIENT_HEADERS,
+            timeout=CLIENT_TIMEOUT,
+            transport=transport
+        )
+        # Successful token validations keyed by token hash: (timestamp, result)
+        self._token_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
     
-    def create_note(self, token: str, content: str, note_type: int = 0) -> Dict[str, Any]:
-        """Create a new note using the upsert endpoint."""
-        if not content or not content.strip():
-            return {
-                'success': False,
-                'error': 'validation',
-                'message': 'Note content cannot be empty'
-            }
-        
-        note_data = {
-            'content': content.strip(),
-            'type': note_type
-        }
+    async def aclose(self):
+        """Close the underlying HTTP client and its connection pool."""
+        await self._client.aclose()
+    
+    async def _request(self, method: str, url: str, token: Token, body: Optional[Dict[str, Any]] = None,
+                       parse: bool = True, **kwargs) -> Dict[str, Any]:
+        """Send an authenticated request and classify the response.
         
+        Returns {'success': True, 'data': ...} on success, otherwise an error
+        dict with 'error' and 'message' (plus 'status_code' for API errors).
+        """
         try:
-            # Ensure base_url ends with / and endpoint doesn't start with /
-            base_url = self.base_url.rstrip('/') + '/'
-            endpoint = 'note/upsert'
-            url = urljoin(base_url, endpoint)
-            
-            headers = {'Authorization': f'Bearer {token}'}
+            if body is not None:
+                kwargs['headers'] = _json_headers(token)
+                kwargs['content'] = orjson.dumps(body)
+            else:
+                kwargs['headers'] = _auth_headers(token)
             
-            response = self.session.post(
-                url=url,
-                headers=headers,
-                json=note_data,
-                timeout=30
-            )
+            response = await self._client.request(method, url, **kwargs)
             
-            logger.info(f"API POST /note/upsert - Status: {response.status_code}")
+            logger.info(f"API {method} {response.url.path} - Status: {response.status_code}")
             
             if response.status_code == 401:
+                self._invalidate_token(token)
                 return {
                     'success': False,
                     'error': 'unauthorized',
@@ -79,21 +109,33 @@ class BlinkoAPI:
                     'status_code': response.status_code
                 }
             
-            result = response.json()
+            data = None
+            if parse:
+                data = orjson.loads(response.content)
+                # Callers read fields off the body, so anything but a JSON
+                # object is treated as a malformed response
+                if not isinstance(data, dict):
+                    logger.error(f"Unexpected response body from Blinko API: {type(data).__name__}")
+                    return {
+                        'success': False,
+                        'error': 'unexpected',
+                        'message': 'Unexpected response from Blinko server'
+                    }
+            
             return {
                 'success': True,
-                'data': result,
-                'note_id': result.get('id')
+                'data': data
             }
                 
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             logger.error("Timeout making request to Blinko API")
             return {
                 'success': False,
                 'error': 'timeout',
                 'message': 'Request timed out. Please try again.'
             }
-        except requests.exceptions.ConnectionError:
+        except (httpx.NetworkError, httpx.RemoteProtocolError):
+            # Covers failing to connect as well as the connection dropping mid-request
             logger.error("Connection error making request to Blinko API")
             return {
                 'success': False,
@@ -108,9 +150,10 @@ class BlinkoAPI:
                 'message': f'Unexpected error: {str(e)}'
             }
     
-    def update_note(self, token: str, note_id: str, content: str, note_type: int = 0) -> Dict[str, Any]:
-        """Update an existing note using the upsert endpoint with note ID."""
-        if not content or not content.strip():
+    async def create_note(self, token: Token, content: str, note_type: int = 0) -> Dict[str, Any]:
+        """Create a new note using the upsert endpoint."""
+        stripped = content.strip() if content else ''
+        if not stripped:
             return {
                 'success': False,
                 'error': 'validation',
@@ -118,125 +161,85 @@ class BlinkoAPI:
             }
         
         note_data = {
-            'id': note_id,
-            'content': content.strip(),
+            'content': stripped,
             'type': note_type
         }
         
-        try:
-            # Ensure base_url ends with / and endpoint doesn't start with /
-            base_url = self.base_url.rstrip('/') + '/'
-            endpoint = 'note/upsert'
-            url = urljoin(base_url, endpoint)
-            
-            headers = {'Authorization': f'Bearer {token}'}
-            
-            response = self.session.post(
-                url=url,
-                headers=headers,
-                json=note_data,
-                timeout=30
-            )
-            
-            logger.info(f"API POST /note/upsert (update) - Status: {response.status_code}")
-            
-            if response.status_code == 401:
-                return {
-                    'success': False,
-                    'error': 'unauthorized',
-                    'message': 'Invalid or expired token. Please reconfigure with /configure'
-                }
-            
-            if response.status_code >= 400:
-                return {
-                    'success': False,
-                    'error': 'api_error',
-                    'message': f'API error: {response.status_code}',
-                    'status_code': response.status_code
-                }
-            
-            result = response.json()
-            return {
-                'success': True,
-                'data': result,
-                'note_id': result.get('id', note_id)
-            }
-                
-        except requests.exceptions.Timeout:
-            logger.error("Timeout making request to Blinko API")
-            return {
-                'success': False,
-                'error': 'timeout',
-                'message': 'Request timed out. Please try again.'
-            }
-        except requests.exceptions.ConnectionError:
-            logger.error("Connection error making request to Blinko API")
-            return {
-                'success': False,
-                'error': 'connection',
-                'message': 'Failed to connect to Blinko server. Please check your configuration.'
-            }
-        except Exception as e:
-            logger.error(f"Unexpected error making request to Blinko API: {e}")
+        result = await self._request('POST', self._upsert_url, token, body=note_data)
+        if result['success']:
+            result['note_id'] = result['data'].get('id')
+        return result
+    
+    async def update_note(self, token: Token, note_id: str, content: str, note_type: int = 0) -> Dict[str, Any]:
+        """Update an existing note using the upsert endpoint with note ID."""
+        stripped = content.strip() if content else ''
+        if not stripped:
             return {
                 'success': False,
-                'error': 'unexpected',
-                'message': f'Unexpected error: {str(e)}'
+                'error': 'validation',
+                'message': 'Note content cannot be empty'
             }
+        
+        note_data = {
+            'id': note_id,
+            'content': stripped,
+            'type': note_type
+        }
+        
+        result = await self._request('POST', self._upsert_url, token, body=note_data)
+        if result['success']:
+            result['note_id'] = result['data'].get('id', note_id)
+        return result
     
-    def test_token(self, token: str) -> Dict[str, Any]:
-        """Test if a token is valid by making a simple request."""
-        try:
-            # Try to access the API with the token without creating a note
-            # This is a simple way to validate the token
-            headers = {'Authorization': f'Bearer {token}'}
-            
-            # Use a simple GET request to test authentication
-            # If this endpoint doesn't exist, we'll catch the error appropriately
-            base_url = self.base_url.rstrip('/') + '/'
-            
-            response = self.session.get(
-                url=urljoin(base_url, 'note'),  # Try to list notes (common endpoint)
-                headers=headers,
-                timeout=10
-            )
-            
-            if response.status_code == 401:
-                return {
-                    'success': False,
-                    'error': 'unauthorized',
-                    'message': 'Invalid or expired token'
-                }
-            
-            # If we get any response that's not unauthorized, consider token valid
+    @staticmethod
+    def _token_key(token: Token) -> str:
+        """Key the validation cache by a fixed-size digest, the same for str and bytes tokens."""
+        if isinstance(token, str):
+            token = token.encode()
+        return hashlib.sha256(token).hexdigest()
+    
+    def _invalidate_token(self, token: Token):
+        """Drop a cached token validation, e.g. after the server rejected it."""
+        self._token_cache.pop(self._token_key(token), None)
+    
+    async def test_token(self, token: Token) -> Dict[str, Any]:
+        """Test if a token is valid, reusing a recent successful validation."""
+        key = self._token_key(token)
+        cached = self._token_cache.get(key)
+        if cached and time.monotonic() - cached[0] < TOKEN_CACHE_TTL:
+            return cached[1]
+        
+        result = await self._validate_token(token)
+        # Only cache successes; failures (timeouts, bad tokens) are re-checked
+        if result['success']:
+            self._token_cache[key] = (time.monotonic(), result)
+        return result
+    
+    async def _validate_token(self, token: Token) -> Dict[str, Any]:
+        """Validate a token against the server by making a simple request."""
+        # Try to list notes (common endpoint) without creating one; only the
+        # status code matters, so the response body is not parsed
+        result = await self._request('GET', self._note_url, token, parse=False, timeout=10)
+        
+        if result['success'] or result.get('status_code') == 403:
             # Even 403 (forbidden) means the token is recognized
-            if response.status_code in [200, 403]:
-                return {
-                    'success': True,
-                    'message': 'Token is valid'
-                }
-            
-            # For other status codes, still consider it valid if not unauthorized
             return {
                 'success': True,
-                'message': 'Token appears valid (authentication successful)'
-            }
-                
-        except requests.exceptions.Timeout:
-            return {
-                'success': False,
-                'error': 'timeout',
-                'message': 'Request timed out. Server may be unavailable.'
+                'message': 'Token is valid'
             }
-        except requests.exceptions.ConnectionError:
+        
+        if result['error'] == 'unauthorized':
             return {
                 'success': False,
-                'error': 'connection',
-                'message': 'Failed to connect to Blinko server.'
+                'error': 'unauthorized',
+                'message': 'Invalid or expired token'
             }
-        except Exception as e:
+        
+        # For other status codes, still consider it valid if not unauthorized
+        if result['error'] == 'api_error':
             return {
-                'success': False,
-                'error': 'unexpected',
-                'message': f'Unexpected error: {str(e)}'
+                'success': True,
+                'message': 'Token appears valid (authentication successful)'
             }
+        
+        return result
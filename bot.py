@@ -19,19 +19,16 @@ Usage:
 """
 
 import os
+import asyncio
 import logging
+from typing import Optional
 from telegram import Update
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
     ContextTypes, filters
 )
-from dotenv import load_dotenv
-from storage import UserStorage
+from storage import InvalidToken, UserStorage
 from blinko_api import BlinkoAPI
-import re
-
-# Load environment variables
-load_dotenv()
 
 # Configure logging
 logging.basicConfig(
@@ -40,6 +37,112 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Note-message mappings older than this are purged, once per interval (seconds)
+NOTE_MESSAGE_RETENTION_DAYS = 30
+NOTE_PURGE_INTERVAL = 3600
+
+# Message templates, built once at import time
+WELCOME_TEMPLATE = """
+🎉 *Welcome to Blinko Telegram Bot!*
+
+Hello {name}! I help you save notes to your Blinko server.
+
+*Quick Setup:*
+1. Get your Blinko API token
+2. Use `/configure <your_token>` to set it up
+3. Start sending notes with `/note` or `/blinko`
+
+*Commands:*
+• `/configure <token>` - Set your API token
+• `/note <text>` - Save a note
+• `/blinko <text>` - Save a blinko
+• `/status` - Check configuration
+• `/reset` - Remove stored token
+• `/help` - Show help
+
+💡 *Tip:* Reply to your own `/note` or `/blinko` messages to update them!
+
+Ready to get started? Use `/configure` with your Blinko token!
+"""
+
+HELP_TEXT = """
+🤖 *Blinko Telegram Bot Help*
+
+*Configuration:*
+• `/configure <token>` - Set your Blinko API token
+• `/status` - Check current configuration
+• `/reset` - Remove stored configuration
+
+*Creating Notes:*
+• `/note This is my note` - Create a note
+• `/blinko Remember to call mom` - Create a blinko
+
+*Updating Notes:*
+• Reply to your own note/blinko messages with new content to update them
+
+*Examples:*
+• `/note Buy groceries: milk, bread, eggs`
+• `/blinko Meeting with team at 3 PM tomorrow`
+• `/note #idea New feature for the app`
+
+Need help? Make sure you've configured your token first!
+"""
+
+NOT_CONFIGURED_MESSAGE = (
+    "❗ *Token Not Configured*\n\n"
+    "You must configure your Blinko token first.\n"
+    "Use `/configure <your_token>` to get started."
+)
+
+AUTH_FAILED_MESSAGE = (
+    "❌ *Authentication Failed*\n\n"
+    "Your token appears to be invalid or expired.\n"
+    "Please reconfigure with `/configure <new_token>`"
+)
+
+UNREADABLE_TOKEN_MESSAGE = (
+    "❌ *Stored Token Unreadable*\n\n"
+    "Your saved token can no longer be decrypted.\n"
+    "Please reconfigure with `/configure <your_token>`"
+)
+
+CREATE_SUCCESS_TEMPLATE = "✅ *{title} Added to Blinko!*{note_info}\n\n📝 {preview}"
+CREATE_FAILED_TEMPLATE = (
+    "❌ *Failed to Add {title}*\n\n"
+    "Error: {error}\n\n"
+    "Please try again or check your configuration."
+)
+UPDATE_SUCCESS_TEMPLATE = "✅ *{title} Updated!*\n\n📝 {preview}"
+UPDATE_FAILED_TEMPLATE = (
+    "❌ *Failed to Update {title}*\n\n"
+    "Error: {error}\n\n"
+    "Please try again or check your configuration."
+)
+
+STATUS_TEMPLATE = """
+{emoji} *Configuration Status*
+
+👤 *User:* {username}
+🔑 *Token:* {status}
+🌐 *Blinko URL:* {url}
+📅 *Configured:* {configured}
+
+{footer}
+"""
+
+def _preview(s: str, n: int = 100) -> str:
+    """Truncate text for message previews, preferring to end on a word boundary."""
+    if len(s) <= n:
+        return s
+    cut = s[:n]
+    # If the cut lands mid-word, drop that partial word unless doing so
+    # would discard most of the preview
+    if not s[n].isspace():
+        words = cut.rsplit(maxsplit=1)
+        if len(words) == 2 and len(words[0]) >= n // 2:
+            cut = words[0]
+    return cut.rstrip() + '...'
+
 class BlinkoTelegramBot:
     """Main Telegram bot class for Blinko integration."""
     
@@ -52,13 +155,22 @@ class BlinkoTelegramBot:
         if not self.bot_token:
             raise ValueError("BOT_TOKEN environment variable is required")
         
-        # Initialize storage and API
+        # Initialize storage and API; storage calls are blocking SQLite work,
+        # so handlers run them via asyncio.to_thread
         self.storage = UserStorage(self.database_path, self.encryption_key)
         self.blinko_api = BlinkoAPI(self.blinko_base_url)
         
-        # Initialize application
-        self.application = Application.builder().token(self.bot_token).build()
+        # Initialize application; concurrent updates let one user's Blinko
+        # request overlap with other users' updates instead of queueing them
+        self.application = (
+            Application.builder()
+            .token(self.bot_token)
+            .concurrent_updates(True)
+            .post_shutdown(self._post_shutdown)
+            .build()
+        )
         self._setup_handlers()
+        self._setup_jobs()
     
     def _setup_handlers(self):
         """Set up command and message handlers."""
@@ -77,58 +189,28 @@ class BlinkoTelegramBot:
             self.handle_reply_update
         ))
     
+    def _setup_jobs(self):
+        """Set up recurring maintenance jobs."""
+        self.application.job_queue.run_repeating(
+            self._purge_note_messages,
+            interval=NOTE_PURGE_INTERVAL,
+            first=0
+        )
+    
+    async def _purge_note_messages(self, context: ContextTypes.DEFAULT_TYPE):
+        """Drop note-message mappings too old to be replied to."""
+        removed = await asyncio.to_thread(self.storage.purge_old_note_messages, NOTE_MESSAGE_RETENTION_DAYS)
+        if removed:
+            logger.info(f"Purged {removed} note message mappings older than {NOTE_MESSAGE_RETENTION_DAYS} days")
+    
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command."""
         user = update.effective_user
-        welcome_message = f"""
-🎉 *Welcome to Blinko Telegram Bot!*
-
-Hello {user.first_name}! I help you save notes to your Blinko server.
-
-*Quick Setup:*
-1. Get your Blinko API token
-2. Use `/configure <your_token>` to set it up
-3. Start sending notes with `/note` or `/blinko`
-
-*Commands:*
-• `/configure <token>` - Set your API token
-• `/note <text>` - Save a note
-• `/blinko <text>` - Save a blinko
-• `/status` - Check configuration
-• `/reset` - Remove stored token
-• `/help` - Show help
-
-💡 *Tip:* Reply to your own `/note` or `/blinko` messages to update them!
-
-Ready to get started? Use `/configure` with your Blinko token!
-        """
-        await update.message.reply_text(welcome_message, parse_mode='Markdown')
+        await update.message.reply_text(WELCOME_TEMPLATE.format(name=user.first_name), parse_mode='Markdown')
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command."""
-        help_text = """
-🤖 *Blinko Telegram Bot Help*
-
-*Configuration:*
-• `/configure <token>` - Set your Blinko API token
-• `/status` - Check current configuration
-• `/reset` - Remove stored configuration
-
-*Creating Notes:*
-• `/note This is my note` - Create a note
-• `/blinko Remember to call mom` - Create a blinko
-
-*Updating Notes:*
-• Reply to your own note/blinko messages with new content to update them
-
-*Examples:*
-• `/note Buy groceries: milk, bread, eggs`
-• `/blinko Meeting with team at 3 PM tomorrow`
-• `/note #idea New feature for the app`
-
-Need help? Make sure you've configured your token first!
-        """
-        await update.message.reply_text(help_text, parse_mode='Markdown')
+        await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
     
     async def configure_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /configure command to set user token."""
@@ -155,7 +237,7 @@ Need help? Make sure you've configured your token first!
         # Test the token before storing
         await update.message.reply_text("🔄 Testing your token...")
         
-        test_result = self.blinko_api.test_token(token)
+        test_result = await self.blinko_api.test_token(token)
         
         if not test_result['success']:
             if test_result['error'] == 'unauthorized':
@@ -177,7 +259,7 @@ Need help? Make sure you've configured your token first!
             return
         
         # Store the token
-        if self.storage.store_user_token(user_id, username, token):
+        if await asyncio.to_thread(self.storage.store_user_token, user_id, username, token):
             await update.message.reply_text(
                 "✅ *Configuration Successful!*\n\n"
                 "Your Blinko token has been set and verified.\n"
@@ -204,14 +286,9 @@ Need help? Make sure you've configured your token first!
         user_id = update.effective_user.id
         
         # Check if user has configured token
-        token = self.storage.get_user_token(user_id)
+        token = await self._get_token(user_id)
         if not token:
-            await update.message.reply_text(
-                "❗ *Token Not Configured*\n\n"
-                "You must configure your Blinko token first.\n"
-                "Use `/configure <your_token>` to get started.",
-                parse_mode='Markdown'
-            )
+            await update.message.reply_text(NOT_CONFIGURED_MESSAGE, parse_mode='Markdown')
             return
         
         # Get note content
@@ -230,11 +307,14 @@ Need help? Make sure you've configured your token first!
             await update.message.reply_text(f"❗ {type_name.title()} content cannot be empty.")
             return
         
-        # Show typing indicator
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
+        # Show typing indicator while the note is created
+        typing_task = asyncio.create_task(self._send_typing(context, update.effective_chat.id))
         
         # Create the note
-        result = self.blinko_api.create_note(token, note_content, note_type)
+        try:
+            result = await self.blinko_api.create_note(token, note_content, note_type)
+        finally:
+            await typing_task
         
         if result['success']:
             note_info = ""
@@ -243,14 +323,16 @@ Need help? Make sure you've configured your token first!
             
             # Send response and store message mapping for reply-to-update functionality
             sent_message = await update.message.reply_text(
-                f"✅ *{type_name.title()} Added to Blinko!*{note_info}\n\n"
-                f"📝 {note_content[:100]}{'...' if len(note_content) > 100 else ''}",
+                CREATE_SUCCESS_TEMPLATE.format(
+                    title=type_name.title(), note_info=note_info, preview=_preview(note_content)
+                ),
                 parse_mode='Markdown'
             )
             
             # Store the mapping between this telegram message and the blinko note
             if 'note_id' in result and result['note_id']:
-                self.storage.store_note_message(
+                await asyncio.to_thread(
+                    self.storage.store_note_message,
                     user_id, 
                     sent_message.message_id, 
                     update.effective_chat.id, 
@@ -261,25 +343,29 @@ Need help? Make sure you've configured your token first!
             logger.info(f"{type_name.title()} (type {note_type}) created successfully for user {user_id}: ID {result.get('note_id', 'unknown')}")
         else:
             if result['error'] == 'unauthorized':
-                await update.message.reply_text(
-                    "❌ *Authentication Failed*\n\n"
-                    "Your token appears to be invalid or expired.\n"
-                    "Please reconfigure with `/configure <new_token>`",
-                    parse_mode='Markdown'
-                )
+                await update.message.reply_text(AUTH_FAILED_MESSAGE, parse_mode='Markdown')
             else:
                 await update.message.reply_text(
-                    f"❌ *Failed to Add {type_name.title()}*\n\n"
-                    f"Error: {result['message']}\n\n"
-                    "Please try again or check your configuration.",
+                    CREATE_FAILED_TEMPLATE.format(title=type_name.title(), error=result['message']),
                     parse_mode='Markdown'
                 )
             logger.error(f"Failed to create {type_name} for user {user_id}: {result['message']}")
     
+    async def _send_typing(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+        """Show the typing indicator; failures are logged, never raised into the handler."""
+        try:
+            await context.bot.send_chat_action(chat_id=chat_id, action='typing')
+        except Exception as e:
+            logger.warning(f"Failed to send typing indicator to chat {chat_id}: {e}")
+    
+    async def _get_token(self, user_id: int) -> Optional[bytes]:
+        """Get a user's decrypted token; caching and invalidation are left to storage."""
+        return await asyncio.to_thread(self.storage.get_user_token_bytes, user_id)
+    
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /status command to show configuration status."""
         user_id = update.effective_user.id
-        config = self.storage.get_user_config(user_id)
+        config = await asyncio.to_thread(self.storage.get_user_config, user_id)
         
         if not config:
             await update.message.reply_text(
@@ -290,21 +376,23 @@ Need help? Make sure you've configured your token first!
             )
             return
         
-        # Test current token
-        test_result = self.blinko_api.test_token(config['token'])
+        # Test current token while showing the typing indicator
+        typing_task = asyncio.create_task(self._send_typing(context, update.effective_chat.id))
+        try:
+            test_result = await self.blinko_api.test_token(config['token'])
+        finally:
+            await typing_task
         status_emoji = "✅" if test_result['success'] else "❌"
         status_text = "Active" if test_result['success'] else "Invalid/Expired"
         
-        status_message = f"""
-{status_emoji} *Configuration Status*
-
-👤 *User:* {config['username']}
-🔑 *Token:* {status_text}
-🌐 *Blinko URL:* {self.blinko_base_url}
-📅 *Configured:* {config['created_at'][:10]}
-
-{f"⚠️ Token issue: {test_result['message']}" if not test_result['success'] else "🎉 Ready to send notes!"}
-        """
+        status_message = STATUS_TEMPLATE.format(
+            emoji=status_emoji,
+            username=config['username'],
+            status=status_text,
+            url=self.blinko_base_url,
+            configured=config['created_at'].strftime('%Y-%m-%d'),
+            footer="🎉 Ready to send notes!" if test_result['success'] else f"⚠️ Token issue: {test_result['message']}"
+        )
         
         await update.message.reply_text(status_message, parse_mode='Markdown')
     
@@ -312,7 +400,7 @@ Need help? Make sure you've configured your token first!
         """Handle /reset command to remove user configuration."""
         user_id = update.effective_user.id
         
-        if self.storage.remove_user_token(user_id):
+        if await asyncio.to_thread(self.storage.remove_user_token, user_id):
             await update.message.reply_text(
                 "✅ *Configuration Removed*\n\n"
                 "Your Blinko token has been deleted from our secure storage.\n"
@@ -329,14 +417,9 @@ Need help? Make sure you've configured your token first!
         user_id = update.effective_user.id
         
         # Check if user has configured token
-        token = self.storage.get_user_token(user_id)
+        token = await self._get_token(user_id)
         if not token:
-            await update.message.reply_text(
-                "❗ *Token Not Configured*\n\n"
-                "You must configure your Blinko token first.\n"
-                "Use `/configure <your_token>` to get started.",
-                parse_mode='Markdown'
-            )
+            await update.message.reply_text(NOT_CONFIGURED_MESSAGE, parse_mode='Markdown')
             return
         
         # Check if this is a reply to a bot message that contains a note
@@ -345,7 +428,8 @@ Need help? Make sure you've configured your token first!
             return  # Not a reply to the bot
         
         # Check if we have a note mapping for this message
-        note_info = self.storage.get_note_from_reply(
+        note_info = await asyncio.to_thread(
+            self.storage.get_note_from_reply,
             user_id, 
             reply_to_message.message_id, 
             update.effective_chat.id
@@ -359,29 +443,32 @@ Need help? Make sure you've configured your token first!
             await update.message.reply_text("❗ Update content cannot be empty.")
             return
         
-        # Show typing indicator
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
+        # Show typing indicator while the note is updated
+        typing_task = asyncio.create_task(self._send_typing(context, update.effective_chat.id))
         
         # Update the note
-        result = self.blinko_api.update_note(
-            token, 
-            note_info['note_id'], 
-            new_content, 
-            note_info['note_type']
-        )
+        try:
+            result = await self.blinko_api.update_note(
+                token, 
+                note_info['note_id'], 
+                new_content, 
+                note_info['note_type']
+            )
+        finally:
+            await typing_task
         
         type_name = "note" if note_info['note_type'] == 0 else "blinko"
         
         if result['success']:
             # Send confirmation and store new message mapping
             sent_message = await update.message.reply_text(
-                f"✅ *{type_name.title()} Updated!*\n\n"
-                f"📝 {new_content[:100]}{'...' if len(new_content) > 100 else ''}",
+                UPDATE_SUCCESS_TEMPLATE.format(title=type_name.title(), preview=_preview(new_content)),
                 parse_mode='Markdown'
             )
             
             # Store the new message mapping
-            self.storage.store_note_message(
+            await asyncio.to_thread(
+                self.storage.store_note_message,
                 user_id, 
                 sent_message.message_id, 
                 update.effective_chat.id, 
@@ -392,17 +479,10 @@ Need help? Make sure you've configured your token first!
             logger.info(f"{type_name.title()} updated successfully for user {user_id}: ID {note_info['note_id']}")
         else:
             if result['error'] == 'unauthorized':
-                await update.message.reply_text(
-                    "❌ *Authentication Failed*\n\n"
-                    "Your token appears to be invalid or expired.\n"
-                    "Please reconfigure with `/configure <new_token>`",
-                    parse_mode='Markdown'
-                )
+                await update.message.reply_text(AUTH_FAILED_MESSAGE, parse_mode='Markdown')
             else:
                 await update.message.reply_text(
-                    f"❌ *Failed to Update {type_name.title()}*\n\n"
-                    f"Error: {result['message']}\n\n"
-                    "Please try again or check your configuration.",
+                    UPDATE_FAILED_TEMPLATE.format(title=type_name.title(), error=result['message']),
                     parse_mode='Markdown'
                 )
             logger.error(f"Failed to update {type_name} for user {user_id}: {result['message']}")
@@ -410,6 +490,16 @@ Need help? Make sure you've configured your token first!
     async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE):
         """Handle errors."""
         logger.error(f"Exception while handling an update: {context.error}")
+        
+        # A token stored under a different ENCRYPTION_KEY can't be decrypted;
+        # the only way out for the user is to configure it again
+        if isinstance(context.error, InvalidToken) and isinstance(update, Update) and update.effective_message:
+            await update.effective_message.reply_text(UNREADABLE_TOKEN_MESSAGE, parse_mode='Markdown')
+    
+    async def _post_shutdown(self, application: Application):
+        """Release the Blinko API connection pool and database on shutdown."""
+        await self.blinko_api.aclose()
+        self.storage.close()
     
     def run(self):
         """Start the bot."""
@@ -422,6 +512,11 @@ Need help? Make sure you've configured your token first!
 
 def main():
     """Main function to run the bot."""
+    from dotenv import load_dotenv
+    
+    # Load environment variables
+    load_dotenv()
+    
     try:
         bot = BlinkoTelegramBot()
         bot.run()
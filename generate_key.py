@@ -3,11 +3,12 @@
 Generate a 32-byte encryption key for Blinko Telegram Bot
 """
 
-from cryptography.fernet import Fernet
+import base64
+import os
 
 def generate_encryption_key():
-    """Generate a 32-byte encryption key."""
-    key = Fernet.generate_key()
+    """Generate a 32-byte encryption key in Fernet's url-safe base64 format."""
+    key = base64.urlsafe_b64encode(os.urandom(32))
     return key.decode()
 
 if __name__ == "__main__":
@@ -1,176 +1,592 @@
+import os
+import base64
+import collections
+import collections.abc
+import queue
 import sqlite3
 import logging
-from cryptography.fernet import Fernet
-from typing import Optional
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+try:
+    # Optional Rust implementation of Fernet, much faster on small tokens
+    import rfernet
+    # Raised by decrypt() when a stored token can't be read with this key
+    InvalidToken = rfernet.DecryptionError
+except ImportError:
+    rfernet = None
+    from cryptography.fernet import Fernet, InvalidToken
 
 logger = logging.getLogger(__name__)
 
+# Bytes of the database file SQLite may memory-map for reads (256 MB)
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Buffered note-message mappings are written once this many are pending,
+# or after this many seconds, whichever comes first
+NOTE_FLUSH_SIZE = 50
+NOTE_FLUSH_INTERVAL = 0.25
+
+# Most queued writes the writer thread groups into one transaction
+WRITE_BATCH_SIZE = 64
+
+# Retries for a statement that found the database locked or busy, and the
+# first backoff delay in seconds (doubled on every retry)
+BUSY_RETRIES = 3
+BUSY_BACKOFF = 0.05
+
+# Seconds between batched updated_at writes for users whose token was re-stored
+TOUCH_FLUSH_INTERVAL = 60
+
+# SQL for the hot-path queries, defined once so every call reuses the same
+# statement text and hits each connection's prepared-statement cache
+SQL_STORE_TOKEN = """
+    INSERT INTO user_tokens 
+    (user_id, username, encrypted_token, blinko_url) 
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET 
+        username = excluded.username,
+        encrypted_token = excluded.encrypted_token,
+        blinko_url = excluded.blinko_url
+"""
+# updated_at is bumped separately, in batches; see flush_touched_users()
+SQL_TOUCH_USER = "UPDATE user_tokens SET updated_at = CURRENT_TIMESTAMP WHERE user_id = ?"
+SQL_GET_CONFIG = """
+    SELECT encrypted_token, blinko_url, username, created_at 
+    FROM user_tokens WHERE user_id = ?
+"""
+SQL_REMOVE_TOKEN = "DELETE FROM user_tokens WHERE user_id = ?"
+SQL_USER_EXISTS = "SELECT 1 FROM user_tokens WHERE user_id = ?"
+# The user count is kept in a meta row so reading it doesn't scan the table
+SQL_COUNT_USERS = "SELECT v FROM meta WHERE k = 'user_count'"
+SQL_ADJUST_USER_COUNT = "UPDATE meta SET v = v + ? WHERE k = 'user_count'"
+SQL_STORE_NOTE_MESSAGE = """
+    INSERT INTO note_messages 
+    (user_id, message_id, chat_id, note_id, note_type) 
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, message_id, chat_id) DO UPDATE SET 
+        note_id = excluded.note_id,
+        note_type = excluded.note_type
+"""
+SQL_GET_NOTE_MESSAGE = """
+    SELECT note_id, note_type FROM note_messages INDEXED BY idx_note_messages_covering 
+    WHERE user_id = ? AND message_id = ? AND chat_id = ?
+"""
+SQL_PURGE_NOTE_MESSAGES = "DELETE FROM note_messages WHERE created_at < datetime('now', ?)"
+
+# Lookups compiled on every read connection when it is opened
+WARM_QUERIES = (
+    (SQL_GET_CONFIG, (0,)),
+    (SQL_COUNT_USERS, ()),
+    (SQL_GET_NOTE_MESSAGE, (0, 0, 0)),
+)
+
+# Prepared statements kept per connection (sqlite3 defaults to 128)
+STATEMENT_CACHE_SIZE = 256
+
+# Convert columns by their declared type (e.g. TIMESTAMP) when reading
+DETECT_TYPES = sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+
+# Users whose decrypted token/config are kept in memory
+USER_CACHE_SIZE = 1024
+
+# Return TIMESTAMP columns as datetime objects. Registering our own converter
+# also replaces sqlite3's default one, which is deprecated since Python 3.12.
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+
+class _RustFernet:
+    """Adapter giving rfernet the bytes-in/bytes-out API of cryptography's Fernet."""
+    
+    def __init__(self, key: str):
+        self._fernet = rfernet.Fernet(key)
+    
+    def encrypt(self, data: bytes) -> bytes:
+        return self._fernet.encrypt(data).encode()
+    
+    def decrypt(self, token: bytes) -> bytes:
+        return self._fernet.decrypt(token.decode())
+
+class _LRUCache:
+    """Small thread-safe LRU mapping with per-key invalidation.
+    
+    Readers capture ``generation`` before loading a value and pass it to
+    put(); an invalidation in between makes the put a no-op, so a stale
+    value loaded concurrently with a write is never cached.
+    """
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.generation = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+    
+    def put(self, key, value, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def pop(self, key):
+        with self._lock:
+            self.generation += 1
+            self._data.pop(key, None)
+
+def _with_retry(fn: Callable[..., Any], *args) -> Any:
+    """Call fn, retrying with exponential backoff while the database is locked or busy."""
+    for attempt in range(BUSY_RETRIES + 1):
+        try:
+            return fn(*args)
+        except sqlite3.OperationalError as e:
+            message = str(e)
+            if attempt == BUSY_RETRIES or ('locked' not in message and 'busy' not in message):
+                raise
+            time.sleep(BUSY_BACKOFF * 2 ** attempt)
+
+def _make_cipher(key: str):
+    """Create a Fernet cipher, preferring rfernet when it is installed."""
+    if rfernet is not None:
+        return _RustFernet(key)
+    return Fernet(key)
+
 class UserStorage:
     """Handles secure storage and retrieval of user tokens."""
     
     def __init__(self, db_path: str = "./bot_data.db", encryption_key: Optional[str] = None):
         self.db_path = db_path
         
-        # Initialize encryption
+        # Initialize encryption. Tokens are decrypted without a ttl, so Fernet
+        # never checks their timestamp; encryption only happens on /configure,
+        # so each token's IV is drawn from os.urandom by the cipher as usual.
         if encryption_key:
-            self.cipher = Fernet(encryption_key.encode())
+            self.cipher = _make_cipher(encryption_key)
         else:
             # Generate a key if none provided (for development)
-            key = Fernet.generate_key()
-            self.cipher = Fernet(key)
+            key = base64.urlsafe_b64encode(os.urandom(32)).decode()
+            self.cipher = _make_cipher(key)
             logger.warning("Using auto-generated encryption key. This is not secure for production!")
         
+        # Long-lived writer connection in autocommit mode, used only by the
+        # writer thread after setup since SQLite allows one writer at a time
+        self._conn = self._connect()
+        
         # Initialize database
         self._init_db()
+        
+        # Writes are queued as (function, future) pairs and applied by the
+        # writer thread, which groups whatever is pending into one transaction
+        self._write_q = queue.Queue()
+        self._writer = threading.Thread(target=self._writer_loop, name="storage-writer", daemon=True)
+        self._writer.start()
+        
+        # One read-only connection per worker thread, opened on first use,
+        # so lookups neither contend on the writer nor lock a shared pool
+        self._local = threading.local()
+        self._read_conns = []
+        self._read_conns_lock = threading.Lock()
+        
+        # Note-message mappings waiting to be written in one transaction
+        self._note_buffer = collections.deque()
+        self._note_lock = threading.Lock()
+        self._note_timer: Optional[threading.Timer] = None
+        # Held from taking the buffer until its write commits, so lookups
+        # can wait for mappings that are no longer buffered but not yet stored
+        self._note_flush_lock = threading.Lock()
+        
+        # Users whose updated_at is waiting for the next batched write
+        self._touched = set()
+        self._touch_lock = threading.Lock()
+        self._touch_timer: Optional[threading.Timer] = None
+        
+        # (decrypted token, config) by user_id, invalidated on writes
+        self._config_cache = _LRUCache(USER_CACHE_SIZE)
+    
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        """Open a connection configured for this store."""
+        if readonly:
+            uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None,
+                                   cached_statements=STATEMENT_CACHE_SIZE, detect_types=DETECT_TYPES)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None,
+                                   cached_statements=STATEMENT_CACHE_SIZE, detect_types=DETECT_TYPES)
+        # mmap_size is per connection, so it is set here for the writer and
+        # every reader; memory-mapped reads only pay off on 64-bit hosts
+        conn.executescript(f"""
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-20000;
+            PRAGMA mmap_size={MMAP_SIZE};
+        """)
+        if readonly:
+            for sql, params in WARM_QUERIES:
+                conn.execute(sql, params).fetchall()
+        return conn
+    
+    def _reader(self) -> sqlite3.Connection:
+        """Get this thread's read-only connection, opening it on first use."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect(readonly=True)
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        return conn
+    
+    def _fetchone(self, sql: str, params: Tuple = ()) -> Optional[tuple]:
+        """Run a lookup on this thread's read connection and return the first row."""
+        return _with_retry(lambda: self._reader().execute(sql, params).fetchone())
+    
+    def _write(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Run fn(conn) on the writer thread and return its result once committed."""
+        return _with_retry(self._submit_write, fn)
+    
+    def _submit_write(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        future = Future()
+        self._write_q.put((fn, future))
+        return future.result()
+    
+    def _writer_loop(self):
+        """Apply queued writes, grouping whatever is pending into one transaction."""
+        while True:
+            item = self._write_q.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            # Writes queued while the previous batch was committing ride along
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    item = self._write_q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._apply_batch(batch)
+            except Exception as e:
+                # Never let the writer thread die: callers block on these
+                # futures, and every later write would hang with it
+                logger.error(f"Failed to apply {len(batch)} queued writes: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            if stop:
+                return
+    
+    def _apply_batch(self, batch):
+        """Commit a batch of writes, each in a savepoint so one failure doesn't undo the others."""
+        conn = self._conn
+        results = []
+        try:
+            conn.execute("BEGIN")
+            for fn, future in batch:
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append((future, fn(conn), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    results.append((future, None, e))
+                conn.execute("RELEASE write")
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                try:
+                    conn.execute("ROLLBACK")
+                except sqlite3.Error as rollback_error:
+                    logger.error(f"Failed to roll back write batch: {rollback_error}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
+    def close(self):
+        """Flush buffered writes, stop the writer thread and close all connections."""
+        self.flush_note_messages()
+        self.flush_touched_users()
+        self._write_q.put(None)
+        self._writer.join()
+        self._conn.close()
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
     
     def _init_db(self):
         """Initialize the SQLite database with user tokens and message tracking tables."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS user_tokens (
-                        user_id INTEGER PRIMARY KEY,
-                        username TEXT,
-                        encrypted_token TEXT NOT NULL,
-                        blinko_url TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS note_messages (
-                        user_id INTEGER,
-                        message_id INTEGER,
-                        chat_id INTEGER,
-                        note_id TEXT,
-                        note_type INTEGER,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        PRIMARY KEY (user_id, message_id, chat_id)
-                    )
-                """)
-                conn.commit()
+            conn = self._conn
+            # WAL lets readers proceed while a write is in progress
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS user_tokens (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    encrypted_token BLOB NOT NULL,
+                    blinko_url TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS note_messages (
+                    user_id INTEGER,
+                    message_id INTEGER,
+                    chat_id INTEGER,
+                    note_id TEXT,
+                    note_type INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (user_id, message_id, chat_id)
+                )
+            """)
+            
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    k TEXT PRIMARY KEY,
+                    v INTEGER
+                )
+            """)
+            # Seed the user count from existing rows the first time
+            conn.execute("""
+                INSERT OR IGNORE INTO meta (k, v) 
+                SELECT 'user_count', COUNT(*) FROM user_tokens
+            """)
+            
+            # Covers get_note_from_reply so the lookup never touches the table;
+            # the query names it with INDEXED BY because the planner would
+            # otherwise pick the (unique) primary key index
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_note_messages_covering 
+                ON note_messages (user_id, message_id, chat_id, note_id, note_type)
+            """)
             logger.info("Database initialized successfully")
-        except Exception as e:
+        except sqlite3.Error as e:
             logger.error(f"Failed to initialize database: {e}")
             raise
     
+    def _invalidate_user(self, user_id: int):
+        """Drop cached token and config after the user's row changed."""
+        self._config_cache.pop(user_id)
+    
+    def _decrypt_token(self, encrypted_token) -> bytes:
+        """Decrypt a stored token; rows written before the BLOB column hold text."""
+        if isinstance(encrypted_token, str):
+            encrypted_token = encrypted_token.encode()
+        return self.cipher.decrypt(encrypted_token)
+    
     def store_user_token(self, user_id: int, username: str, token: str, blinko_url: str = None) -> bool:
         """Store an encrypted user token."""
+        return self.store_user_token_bytes(user_id, username, token.encode(), blinko_url)
+    
+    def store_user_token_bytes(self, user_id: int, username: str, token: bytes, blinko_url: str = None) -> bool:
+        """Store an encrypted user token given as bytes, skipping the str round-trip."""
+        encrypted_token = self.cipher.encrypt(token)
+        
+        def write(conn):
+            is_new = conn.execute(SQL_USER_EXISTS, (user_id,)).fetchone() is None
+            conn.execute(SQL_STORE_TOKEN, (user_id, username, sqlite3.Binary(encrypted_token), blinko_url))
+            if is_new:
+                conn.execute(SQL_ADJUST_USER_COUNT, (1,))
+            return is_new
+        
         try:
-            encrypted_token = self.cipher.encrypt(token.encode()).decode()
-            
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("""
-                    INSERT OR REPLACE INTO user_tokens 
-                    (user_id, username, encrypted_token, blinko_url, updated_at) 
-                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-                """, (user_id, username, encrypted_token, blinko_url))
-                conn.commit()
-            
-            logger.info(f"Token stored for user {user_id}")
-            return True
-        except Exception as e:
+            is_new = self._write(write)
+        except sqlite3.Error as e:
             logger.error(f"Failed to store token for user {user_id}: {e}")
             return False
+        self._invalidate_user(user_id)
+        if not is_new:
+            self._touch_user(user_id)
+        
+        logger.info(f"Token stored for user {user_id}")
+        return True
     
-    def get_user_token(self, user_id: int) -> Optional[str]:
-        """Retrieve and decrypt a user token."""
+    def _touch_user(self, user_id: int):
+        """Schedule a user's updated_at to be bumped with the next batch."""
+        with self._touch_lock:
+            self._touched.add(user_id)
+            if self._touch_timer is None:
+                self._touch_timer = threading.Timer(TOUCH_FLUSH_INTERVAL, self.flush_touched_users)
+                self._touch_timer.daemon = True
+                self._touch_timer.start()
+    
+    def flush_touched_users(self) -> bool:
+        """Write pending updated_at bumps in a single transaction."""
+        with self._touch_lock:
+            if self._touch_timer is not None:
+                self._touch_timer.cancel()
+                self._touch_timer = None
+            user_ids, self._touched = self._touched, set()
+        
+        if not user_ids:
+            return True
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute(
-                    "SELECT encrypted_token FROM user_tokens WHERE user_id = ?", 
-                    (user_id,)
-                )
-                result = cursor.fetchone()
-                
-                if result:
-                    encrypted_token = result[0]
-                    token = self.cipher.decrypt(encrypted_token.encode()).decode()
-                    return token
-                return None
-        except Exception as e:
-            logger.error(f"Failed to retrieve token for user {user_id}: {e}")
-            return None
+            self._write(lambda conn: conn.executemany(SQL_TOUCH_USER, ((user_id,) for user_id in user_ids)))
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Failed to update timestamps for {len(user_ids)} users: {e}")
+            return False
     
-    def get_user_config(self, user_id: int) -> Optional[dict]:
-        """Get full user configuration."""
+    def _load_config(self, user_id: int) -> Optional[Tuple[bytes, dict]]:
+        """Get a user's decrypted token bytes and config, from the cache or one row read."""
+        cached = self._config_cache.get(user_id)
+        if cached is not None:
+            return cached
+        
+        generation = self._config_cache.generation
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute("""
-                    SELECT encrypted_token, blinko_url, username, created_at 
-                    FROM user_tokens WHERE user_id = ?
-                """, (user_id,))
-                result = cursor.fetchone()
-                
-                if result:
-                    encrypted_token, blinko_url, username, created_at = result
-                    token = self.cipher.decrypt(encrypted_token.encode()).decode()
-                    return {
-                        'token': token,
-                        'blinko_url': blinko_url,
-                        'username': username,
-                        'created_at': created_at
-                    }
-                return None
-        except Exception as e:
+            result = self._fetchone(SQL_GET_CONFIG, (user_id,))
+        except sqlite3.Error as e:
             logger.error(f"Failed to get config for user {user_id}: {e}")
             return None
+        
+        if not result:
+            return None
+        encrypted_token, blinko_url, username, created_at = result
+        token = self._decrypt_token(encrypted_token)
+        config = {
+            'token': token.decode(),
+            'blinko_url': blinko_url,
+            'username': username,
+            'created_at': created_at
+        }
+        self._config_cache.put(user_id, (token, config), generation)
+        return token, config
+    
+    def get_user_token(self, user_id: int) -> Optional[str]:
+        """Retrieve and decrypt a user token."""
+        cached = self._load_config(user_id)
+        return cached[1]['token'] if cached else None
+    
+    def get_user_token_bytes(self, user_id: int) -> Optional[bytes]:
+        """Retrieve and decrypt a user token as bytes, ready for an auth header."""
+        cached = self._load_config(user_id)
+        return cached[0] if cached else None
+    
+    def get_user_config(self, user_id: int) -> Optional[dict]:
+        """Get full user configuration."""
+        cached = self._load_config(user_id)
+        return dict(cached[1]) if cached else None
     
     def remove_user_token(self, user_id: int) -> bool:
         """Remove a user's token."""
+        def write(conn):
+            if conn.execute(SQL_REMOVE_TOKEN, (user_id,)).rowcount:
+                conn.execute(SQL_ADJUST_USER_COUNT, (-1,))
+        
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("DELETE FROM user_tokens WHERE user_id = ?", (user_id,))
-                conn.commit()
-            logger.info(f"Token removed for user {user_id}")
-            return True
-        except Exception as e:
+            self._write(write)
+        except sqlite3.Error as e:
             logger.error(f"Failed to remove token for user {user_id}: {e}")
             return False
+        self._invalidate_user(user_id)
+        logger.info(f"Token removed for user {user_id}")
+        return True
     
     def get_user_count(self) -> int:
         """Get total number of configured users."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute("SELECT COUNT(*) FROM user_tokens")
-                return cursor.fetchone()[0]
-        except Exception as e:
+            return self._fetchone(SQL_COUNT_USERS)[0]
+        except sqlite3.Error as e:
             logger.error(f"Failed to get user count: {e}")
             return 0
     
     def store_note_message(self, user_id: int, message_id: int, chat_id: int, note_id: str, note_type: int) -> bool:
-        """Store a mapping between a telegram message and a blinko note for reply-to-update functionality."""
+        """Store a mapping between a telegram message and a blinko note for reply-to-update functionality.
+        
+        Mappings are buffered and written in batches; see flush_note_messages().
+        """
+        with self._note_lock:
+            self._note_buffer.append((user_id, message_id, chat_id, note_id, note_type))
+            if len(self._note_buffer) < NOTE_FLUSH_SIZE:
+                if self._note_timer is None:
+                    self._note_timer = threading.Timer(NOTE_FLUSH_INTERVAL, self.flush_note_messages)
+                    self._note_timer.daemon = True
+                    self._note_timer.start()
+                return True
+        return self.flush_note_messages()
+    
+    def flush_note_messages(self) -> bool:
+        """Write all buffered note-message mappings in a single transaction."""
+        with self._note_flush_lock:
+            with self._note_lock:
+                if self._note_timer is not None:
+                    self._note_timer.cancel()
+                    self._note_timer = None
+                # Swap in a fresh buffer; the old deque is handed to executemany as is
+                rows, self._note_buffer = self._note_buffer, collections.deque()
+            
+            if not rows:
+                return True
+            return self.store_note_messages_bulk(rows)
+    
+    def store_note_messages_bulk(self, rows: Iterable[Tuple[int, int, int, str, int]]) -> bool:
+        """Store many (user_id, message_id, chat_id, note_id, note_type) mappings in one transaction."""
+        # A busy/locked retry runs the write again, so one-shot iterators
+        # are materialized first rather than being found already consumed
+        if not isinstance(rows, collections.abc.Sequence):
+            rows = list(rows)
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("""
-                    INSERT OR REPLACE INTO note_messages 
-                    (user_id, message_id, chat_id, note_id, note_type) 
-                    VALUES (?, ?, ?, ?, ?)
-                """, (user_id, message_id, chat_id, note_id, note_type))
-                conn.commit()
+            self._write(lambda conn: conn.executemany(SQL_STORE_NOTE_MESSAGE, rows))
             return True
-        except Exception as e:
-            logger.error(f"Failed to store note message mapping: {e}")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to store note message mappings: {e}")
             return False
     
     def get_note_from_reply(self, user_id: int, reply_to_message_id: int, chat_id: int) -> Optional[dict]:
         """Get note information from a reply to a bot message."""
+        # Make sure a mapping stored moments ago is visible to the lookup,
+        # whether it is still buffered or its flush is in flight
+        self.flush_note_messages()
+        
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute("""
-                    SELECT note_id, note_type FROM note_messages 
-                    WHERE user_id = ? AND message_id = ? AND chat_id = ?
-                """, (user_id, reply_to_message_id, chat_id))
-                result = cursor.fetchone()
-                
-                if result:
-                    note_id, note_type = result
-                    return {
-                        'note_id': note_id,
-                        'note_type': note_type
-                    }
-                return None
-        except Exception as e:
+            result = self._fetchone(SQL_GET_NOTE_MESSAGE, (user_id, reply_to_message_id, chat_id))
+        except sqlite3.Error as e:
             logger.error(f"Failed to get note from reply: {e}")
             return None
+        
+        if result:
+            note_id, note_type = result
+            return {
+                'note_id': note_id,
+                'note_type': note_type
+            }
+        return None
+    
+    def purge_old_note_messages(self, days: int = 30) -> int:
+        """Delete note-message mappings older than the given number of days.
+        
+        Replies to old bot messages are rarely useful, and pruning keeps the
+        lookup index small. Returns the number of mappings removed.
+        """
+        def write(conn):
+            removed = conn.execute(SQL_PURGE_NOTE_MESSAGES, (f'-{days} days',)).rowcount
+            # Refresh planner statistics after the bulk delete
+            conn.execute("PRAGMA optimize")
+            return removed
+        
+        try:
+            return self._write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to purge old note messages: {e}")
+            return 0